@@ -4,7 +4,7 @@ Created on Mon Jan 18 13:25:52 2024
 
 @author: Gregory A. Greene
 """
-# import os
+import os
 from typing import Union, Optional
 import numpy as np
 import fiona
@@ -20,8 +20,7 @@ from rasterio.features import shapes, geometry_window, geometry_mask, rasterize
 from rasterio.merge import merge
 from rasterio.transform import xy, from_origin
 from rasterio.warp import calculate_default_transform, reproject, Resampling
-# from rasterio.windows import Window
-# from rasterio.windows import Window
+from rasterio.windows import Window, from_bounds, intersect as windows_intersect
 # from rasterio.io import MemoryFile
 # from rasterio.transform import Affine
 from shapely.geometry import Point, box, shape, mapping
@@ -54,6 +53,67 @@ def _process_block(block: np.ndarray,
     return [(translate(shape(s), xoff=dx, yoff=dy), v) for s, v in shapes(data, transform=transform)]
 
 
+def _mosaic_block(src_list: list[rio.DatasetReader],
+                  src_windows: list[tuple],
+                  block_win: Window,
+                  block_shape: tuple,
+                  dtype: str,
+                  nodata: Union[int, float]) -> np.ndarray:
+    """
+    Build one block of a mosaic from the windows of the rasters that overlap it.
+    Where rasters overlap, the first valid value is used. As with rasterio's merge(), a cell is filled while it
+    still holds the nodata value (0 if the first raster has no nodata value)
+    :param src_list: list of rasterio dataset reader objects
+    :param src_windows: list of (output window, raster window) tuples locating each raster on the full output grid
+    :param block_win: window of the block in the output raster
+    :param block_shape: shape of the block (bands, rows, cols)
+    :param dtype: data type of the block
+    :param nodata: value assigned to cells without valid data
+    :return: numpy array of the block
+    """
+    block = np.full(block_shape, nodata, dtype=dtype)
+
+    for src, (dst_win, src_win) in zip(src_list, src_windows):
+        # Get the output rows and columns covered by both the raster and the block
+        row_start = max(dst_win.row_off, block_win.row_off)
+        row_stop = min(dst_win.row_off + dst_win.height, block_win.row_off + block_win.height)
+        col_start = max(dst_win.col_off, block_win.col_off)
+        col_stop = min(dst_win.col_off + dst_win.width, block_win.col_off + block_win.width)
+
+        # Skip rasters that do not overlap the block
+        if (row_start >= row_stop) or (col_start >= col_stop):
+            continue
+
+        # Get the matching part of the raster window, so adjacent blocks read adjacent parts of the raster
+        y_scale = src_win.height / dst_win.height
+        x_scale = src_win.width / dst_win.width
+        read_win = Window(src_win.col_off + (col_start - dst_win.col_off) * x_scale,
+                          src_win.row_off + (row_start - dst_win.row_off) * y_scale,
+                          (col_stop - col_start) * x_scale,
+                          (row_stop - row_start) * y_scale)
+
+        # Read only the overlapping window of the raster
+        data = src.read(window=read_win,
+                        out_shape=(src.count, row_stop - row_start, col_stop - col_start),
+                        masked=True)
+
+        # Get the cells of the block that still hold the nodata value
+        rows = slice(row_start - block_win.row_off, row_stop - block_win.row_off)
+        cols = slice(col_start - block_win.col_off, col_stop - block_win.col_off)
+        region = block[:, rows, cols]
+        if np.isnan(nodata):
+            empty = np.isnan(region)
+        elif not np.issubdtype(region.dtype, np.integer):
+            empty = np.isclose(region, nodata)
+        else:
+            empty = region == nodata
+
+        # Fill those cells with the valid raster values
+        np.copyto(region, data.data, where=empty & ~np.ma.getmaskarray(data), casting='unsafe')
+
+    return block
+
+
 def arrayToRaster(array: np.ndarray,
                   out_file: str,
                   ras_profile: dict,
@@ -175,13 +235,10 @@ def changeDtype(src: rio.DatasetReader,
     if nodata_val is None:
         nodata_val = src.profile['nodata']
 
-    # Convert array values to integer type
+    # Convert array values directly to the new data type
     src_array = src.read()
     src_array[src_array == src.nodata] = nodata_val
-    if 'int' in datatype:
-        src_array = np.asarray(src_array, dtype=int)
-    else:
-        src_array = np.asarray(src_array, dtype=float)
+    src_array = np.asarray(src_array, dtype=datatype)
 
     # Get file path of dataset object
     src_path = src.name
@@ -870,11 +927,11 @@ def Integer(src: rio.DatasetReader,
     :param nodata_val: integer value to assign as no data
     :return: rasterio dataset reader object in 'r+' mode
     """
-    # Convert array values to integer type
+    # Convert array values directly to the integer data type
     int_array = src.read()
     if src.nodata != nodata_val:
         int_array[int_array == src.nodata] = nodata_val
-    int_array = np.asarray(int_array, dtype=int)
+    int_array = np.asarray(int_array, dtype=datatype)
 
     # Get file path of dataset object
     src_path = src.name
@@ -899,35 +956,137 @@ def Integer(src: rio.DatasetReader,
 
 
 def mosaicRasters(mosaic_list: list[str, rio.DatasetReader],
-                  out_file: str) -> rio.DatasetReader:
-    """
-    Function mosaics a list of rasterio objects to a new TIFF raster
+                  out_file: str,
+                  extent: Optional[tuple] = None,
+                  remove_sources: bool = False) -> rio.DatasetReader:
+    """
+    Function mosaics a list of rasterio objects to a new tiled TIFF raster (512 x 512 blocks, deflate compression).
+    The output is written one block at a time, reading only the window of each raster overlapping that block.
+    Where rasters overlap, the first valid value is used. As with rasterio's merge(), a cell is filled while it
+    still holds the nodata value, so if the first raster has no nodata value, 0 is used and its 0 cells can be
+    filled by later rasters
     :param mosaic_list: list of rasterio Dataset objects, or paths to raster datasets
     :param out_file: location and name to save output raster
+    :param extent: tuple of output bounds (left, bottom, right, top) in the units of the input rasters
+        (default = None; use the full extent of all rasters)
+    :param remove_sources: delete each raster given as a path in mosaic_list as soon as the last output block it
+        overlaps has been written, to limit peak disk usage. If the mosaic fails part way through, the rasters
+        already deleted cannot be recovered and the output raster is incomplete (default = False)
     :return: rasterio dataset reader object in 'r+' mode
     """
-    for data in mosaic_list:
-        if isinstance(data, str):
-            mosaic_list.extend([rio.open(data)])
-        else:
-            break
-
-    mosaic, output = merge(mosaic_list)
-
-    out_meta = mosaic_list[0].meta
-    out_meta.update(
-        {
-            'driver': 'GTiff',
-            'height': mosaic.shape[1],
-            'width': mosaic.shape[2],
-            'transform': output
-        }
-    )
-
-    with rio.open(out_file, 'w', **out_meta) as dst:
-        dst.write(mosaic)
-        # Calculate new statistics
-        calculateStatistics(dst)
+    # Verify inputs
+    if not isinstance(mosaic_list, list):
+        raise TypeError('[ProcessRasters] mosaicRasters() param "mosaic_list" must be a list of rasterio objects '
+                        'or raster paths')
+    if extent is not None and len(extent) != 4:
+        raise ValueError('[ProcessRasters] mosaicRasters() param "extent" must be a tuple of '
+                         '(left, bottom, right, top)')
+
+    # Skip directory listings on open and enlarge the GDAL block cache while reading the rasters
+    with rio.Env(GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR',
+                 GDAL_CACHEMAX=1024,
+                 NUM_THREADS='ALL_CPUS'):
+        src_list = []
+        try:
+            # Get rasterio dataset objects for any raster paths
+            for data in mosaic_list:
+                src_list.append(rio.open(data) if isinstance(data, str) else data)
+
+            # Use the full extent of all rasters if an output extent was not provided
+            if extent is None:
+                lefts, bottoms, rights, tops = zip(*[src.bounds for src in src_list])
+                extent = (min(lefts), min(bottoms), max(rights), max(tops))
+            left, bottom, right, top = extent
+
+            # Define the output grid using the resolution of the first raster
+            x_res, y_res = src_list[0].res
+            out_transform = from_origin(left, top, x_res, y_res)
+            out_width = int(round((right - left) / x_res))
+            out_height = int(round((top - bottom) / y_res))
+
+            # Locate each raster on the full output grid once, so that adjacent blocks tile exactly
+            src_windows = []
+            for src in src_list:
+                # Get the intersection of the raster bounds and the output extent
+                inter = (max(src.bounds.left, left), max(src.bounds.bottom, bottom),
+                         min(src.bounds.right, right), min(src.bounds.top, top))
+
+                # Rasters that do not overlap the output extent get no window
+                src_windows.append(None)
+                if (inter[0] >= inter[2]) or (inter[1] >= inter[3]):
+                    continue
+                dst_win = from_bounds(*inter, transform=out_transform).round_offsets().round_lengths()
+                row_off, col_off = max(int(dst_win.row_off), 0), max(int(dst_win.col_off), 0)
+                height = min(int(dst_win.height), out_height - row_off)
+                width = min(int(dst_win.width), out_width - col_off)
+                if (height > 0) and (width > 0):
+                    src_windows[-1] = (Window(col_off, row_off, width, height),
+                                       from_bounds(*inter, transform=src.transform))
+
+            # Write a tiled, compressed GeoTIFF
+            out_meta = src_list[0].meta.copy()
+            nodata = out_meta['nodata'] if out_meta['nodata'] is not None else 0
+            out_meta.update(
+                {
+                    'driver': 'GTiff',
+                    'height': out_height,
+                    'width': out_width,
+                    'transform': out_transform,
+                    'tiled': True,
+                    'blockxsize': 512,
+                    'blockysize': 512,
+                    'compress': 'deflate',
+                    'predictor': 3 if np.issubdtype(np.dtype(out_meta['dtype']), np.floating) else 2,
+                    'num_threads': 'ALL_CPUS',
+                    'BIGTIFF': 'IF_SAFER'
+                }
+            )
+
+            with rio.open(out_file, 'w', **out_meta) as dst:
+                block_list = [block_win for _, block_win in dst.block_windows(1)]
+
+                # Get the index of the last output block overlapping each raster path, counting duplicate paths once
+                src_paths = [os.path.normcase(os.path.abspath(data)) if isinstance(data, str) else None
+                             for data in mosaic_list]
+                last_block = {}
+                if remove_sources:
+                    for i, block_win in enumerate(block_list):
+                        for path, win in zip(src_paths, src_windows):
+                            if (path is not None) and (win is not None) and windows_intersect(win[0], block_win):
+                                last_block[path] = i
+
+                # Build and write the mosaic one output block at a time
+                active = [j for j, win in enumerate(src_windows) if win is not None]
+                for i, block_win in enumerate(block_list):
+                    block = _mosaic_block([src_list[j] for j in active],
+                                          src_windows=[src_windows[j] for j in active],
+                                          block_win=block_win,
+                                          block_shape=(dst.count, int(block_win.height), int(block_win.width)),
+                                          dtype=out_meta['dtype'],
+                                          nodata=nodata)
+                    dst.write(block, window=block_win)
+
+                    # Delete raster paths that are not needed for any remaining blocks
+                    for path in [path for path, last in last_block.items() if last == i]:
+                        for j in [j for j, src_path in enumerate(src_paths) if src_path == path]:
+                            src_list[j].close()
+                            if j in active:
+                                active.remove(j)
+                        if os.path.exists(path):
+                            os.remove(path)
+                # Calculate new statistics
+                calculateStatistics(dst)
+        finally:
+            # Close any datasets opened from raster paths, including when the mosaic fails
+            for data, src in zip(mosaic_list, src_list):
+                if isinstance(data, str):
+                    src.close()
+
+        # Delete rasters that did not overlap the output extent
+        if remove_sources:
+            for data in mosaic_list:
+                if isinstance(data, str) and os.path.exists(data):
+                    os.remove(data)
 
     return rio.open(out_file, 'r+')
 
@@ -943,28 +1102,20 @@ def rasterToPoints(src: rio.DatasetReader,
     :param band: integer representing a specific band to extract points from (default = 1)
     :return: None
     """
-    # Get the transform, dimensions, projection, and no data value from the raster
+    # Get the transform, projection, and no data value from the raster
     transform = src.transform
-    width = src.width
-    height = src.height
     crs = src.crs
     nodata = src.nodata
 
     # Read the raster data
     data = src.read(band)  # Use the first band, unless otherwise specified
 
-    # Prepare a list to store point geometries
-    points = []
+    # Get the rows and columns of all cells that are not NoData
+    rows, cols = np.nonzero(data != nodata)
 
-    # Loop through each cell in the raster
-    for row in range(height):
-        for col in range(width):
-            # Check if the cell value is not NoData
-            if data[row, col] != nodata:
-                # Calculate the center of the cell
-                x, y = xy(transform, row, col, offset='center')
-                # Create a point geometry and add it to the list
-                points.append(Point(x, y))
+    # Calculate the center of each cell, and create the point geometries
+    xs, ys = xy(transform, rows, cols, offset='center')
+    points = [Point(x, y) for x, y in zip(xs, ys)]
 
     # Define the schema of the shapefile
     schema = {
@@ -1046,14 +1197,23 @@ def rasterToPoly(src: rio.DatasetReader,
 
 def reprojRaster(src: rio.DatasetReader,
                  out_file: str,
-                 out_crs: str = 'EPSG:4326') -> rio.DatasetReader:
+                 out_crs: str = 'EPSG:4326',
+                 num_threads: Union[int, str] = 'ALL_CPUS') -> rio.DatasetReader:
     """
     Function to reproject a raster to a different coordinate system
     :param src: input rasterio dataset reader object
     :param out_file: location and name to save output raster
     :param out_crs: string defining new projection (e.g., 'EPSG:4326')
+    :param num_threads: number of threads GDAL uses to warp each band, or "ALL_CPUS" to use all available CPUs
+        (default = "ALL_CPUS")
     :return: rasterio dataset reader object in 'r+' mode
     """
+    # Verify inputs
+    if num_threads == 'ALL_CPUS':
+        num_threads = os.cpu_count() or 1
+    elif not isinstance(num_threads, int):
+        raise TypeError('[ProcessRasters] reprojRaster() param "num_threads" must be an integer or "ALL_CPUS"')
+
     # Calculate transformation needed to reproject raster to out_crs
     transform, width, height = calculate_default_transform(
         src.crs, out_crs, src.width, src.height, *src.bounds
@@ -1076,7 +1236,8 @@ def reprojRaster(src: rio.DatasetReader,
                 src_crs=src.crs,
                 dst_transform=transform,
                 dst_crs=out_crs,
-                resampling=Resampling.nearest)
+                resampling=Resampling.nearest,
+                num_threads=num_threads)
 
     # Return new raster as "readonly" rasterio openfile object
     return rio.open(out_file, 'r+')
@@ -1108,7 +1269,7 @@ def resampleRaster(src: rio.DatasetReader,
     src_crs = src.crs
 
     # Prepare the destination array
-    out_array = np.empty((ref_height, ref_width), dtype=src.read(1).dtype)
+    out_array = np.empty((ref_height, ref_width), dtype=src.dtypes[band - 1])
 
     # Reproject the source raster to the reference raster's grid
     reproject(
@@ -1219,16 +1380,16 @@ def toMultiband(path_list: list[str],
     :param out_file: location and name to save output raster
     :return: rasterio dataset reader object in 'r+' mode
     """
-    array_list = [getRaster(path).read(1, masked=True) for path in path_list]
-
-    out_meta = getRaster(path_list[0]).meta.copy()
+    # Get the metadata of the first raster
+    with rio.open(path_list[0]) as src:
+        out_meta = src.meta.copy()
     out_meta.update({'count': len(path_list)})
 
-    shutil.copyfiles(getRaster(path_list[0]).name, out_file)
-
+    # Write each raster to its band in the output, reading one raster at a time
     with rio.open(out_file, 'w', **out_meta) as dest:
-        for band, src in enumerate(array_list, start=1):
-            dest.write(src, band)
+        for band, path in enumerate(path_list, start=1):
+            with rio.open(path) as src:
+                dest.write(src.read(1, masked=True), band)
 
     return rio.open(out_file, 'r+')
 